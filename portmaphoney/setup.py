@@ -8,6 +8,7 @@ setup(
     version="0.1",
     py_modules=["ssdppot"],
     install_requires=["click", "motor", "cachetools", "tqdm", "aiohttp==3.4.4"],
+    extras_require={"export": ["pyarrow>=7"]},
     package_data={"ssdppot": [glob.glob("ssdppot/data/*")]},
     entry_points="""
         [console_scripts]
@@ -1,7 +1,9 @@
 import asyncio
+import functools
 import json
 import logging
 import os
+import re
 import time
 
 import tqdm
@@ -20,6 +22,21 @@ def read_data_file(name):
     return open(get_data(name)).read()
 
 
+SOAP_ARG_RE = re.compile(r"<(New\w+)(?:\s[^>]*)?>([^<]*)</\1>")
+
+
+def soap_action_name(action):
+    """Return the bare action name from a SOAPACTION header value."""
+    return action.strip().strip('"').rpartition("#")[2]
+
+
+def parse_soap_args(body):
+    """Extract the `New*` arguments from a SOAP request body."""
+    if not body:
+        return {}
+    return dict(SOAP_ARG_RE.findall(body))
+
+
 class FlushEveryX:
     """Asynchronous list implementation for batching inserts per interval.
 
@@ -57,33 +74,43 @@ class FlushEveryX:
             self.data.clear()
 
 
-async def generic_mongo_batch_inserter(queue, collection):
-    """Reads the result queue from crawler and inserts entries periodically to mongodb.
+async def insert_results(collection, results):
+    """Insert the results to mongodb, writing them into a file on failure."""
+    if not len(results):
+        return
+    try:
+        await collection.insert_many(results, ordered=False)
+    except Exception as ex:
+        _LOGGER.error("Unable to insert to mongodb: %s", ex)
+        with open("unable_to_save", "a") as f:
+            f.write(json.dumps(results) + "\n")
 
-    Requires json serializable data."""
+    _LOGGER.info("Added %s results to mongo", len(results))
 
-    async def insert_results(results):
-        if not len(results):
-            return
-        try:
-            await collection.insert_many(results, ordered=False)
-        except Exception as ex:
-            _LOGGER.error("Unable to insert to mongodb: %s", ex)
-            with open("unable_to_save", "a") as f:
-                f.write(json.dumps(results) + "\n")
 
-        _LOGGER.info("Added %s results to mongo", len(results))
+async def generic_mongo_batch_inserter(queue, collection):
+    """Reads the result queue from crawler and inserts entries periodically to mongodb.
+
+    Requires json serializable data. Put None into the queue to stop it, e.g.,
+    when shutting down, the buffered entries are inserted before returning."""
 
     interval = 5
-    res_queue = FlushEveryX(interval=interval, flush_coro=insert_results)
+    res_queue = FlushEveryX(
+        interval=interval, flush_coro=functools.partial(insert_results, collection)
+    )
     while True:
         try:
             res = await asyncio.wait_for(queue.get(), timeout=interval)
+            if res is None:
+                queue.task_done()
+                break
             await res_queue.push(res)
             queue.task_done()
         except asyncio.TimeoutError:
             await res_queue.flush(force=True)
 
+    await res_queue.flush(force=True)
+
 
 class TqdmHandler(logging.Handler):
     """Logging handler to unbreak the stdout output.
@@ -121,3 +121,31 @@ SCD_PATHS = [
     "/RootDeviceDesc.xml",
     "/devicedesc.xml",
 ]
+
+# Actions of the WANIPConnection and WANPPPConnection services counted by name,
+# the rest are counted under OTHER_ACTIONS
+IGD_ACTIONS = [
+    "AddAnyPortMapping",
+    "AddPortMapping",
+    "DeletePortMapping",
+    "DeletePortMappingRange",
+    "ForceTermination",
+    "GetAutoDisconnectTime",
+    "GetConnectionTypeInfo",
+    "GetExternalIPAddress",
+    "GetGenericPortMappingEntry",
+    "GetIdleDisconnectTime",
+    "GetListOfPortMappings",
+    "GetNATRSIPStatus",
+    "GetSpecificPortMappingEntry",
+    "GetStatusInfo",
+    "GetWarnDisconnectDelay",
+    "RequestConnection",
+    "RequestTermination",
+    "SetAutoDisconnectTime",
+    "SetConnectionType",
+    "SetIdleDisconnectTime",
+    "SetWarnDisconnectDelay",
+]
+
+OTHER_ACTIONS = "other_actions"
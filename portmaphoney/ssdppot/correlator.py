@@ -0,0 +1,209 @@
+"""
+Correlate discoveries, SCD fetches and SOAP actions per source into sessions.
+
+A typical injection attempt consists of an M-SEARCH to 1900/udp, followed by fetching the
+device description and POSTing GetGenericPortMappingEntry/AddPortMapping actions,
+often to different ports. Instead of self-joining `discoveries` and `http` afterwards,
+the events are grouped here per source address and a compact summary is emitted
+to the result queue once the source has been idle for `idle_timeout` seconds.
+"""
+
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+
+from .common import parse_soap_args, soap_action_name
+
+_LOGGER = logging.getLogger(__name__)
+
+# Argument names of AddPortMapping stored for each injected mapping
+MAPPING_ARGS = {
+    "NewRemoteHost": "remote_host",
+    "NewExternalPort": "external_port",
+    "NewProtocol": "protocol",
+    "NewInternalPort": "internal_port",
+    "NewInternalClient": "internal_client",
+    "NewEnabled": "enabled",
+    "NewPortMappingDescription": "description",
+    "NewLeaseDuration": "lease_duration",
+}
+
+# Enrichment fields copied from the first event of the session
+ENRICHMENT_FIELDS = ["asn", "as_country", "as_name"]
+
+# Key for counting the actions beyond the first `max_actions` distinct ones
+OTHER_ACTIONS = "_other"
+
+
+class Session:
+    __slots__ = [
+        "srcip",
+        "start",
+        "end",
+        "events",
+        "timeline",
+        "ports",
+        "actions",
+        "mappings",
+        "extra",
+        "continued",
+    ]
+
+    def __init__(self, srcip, ts, continued=False):
+        self.srcip = srcip
+        self.continued = continued
+        self.start = self.end = ts
+        self.events = 0
+        self.timeline = []
+        self.ports = set()
+        self.actions = Counter()
+        self.mappings = []
+        self.extra = {}
+
+    def to_record(self):
+        return {
+            "srcip": self.srcip,
+            "start": self.start,
+            "end": self.end,
+            "duration": (self.end - self.start).total_seconds(),
+            "events": self.events,
+            "timeline": self.timeline,
+            "timeline_truncated": self.events > len(self.timeline),
+            "ports": sorted(self.ports),
+            # SOAP actions are client-supplied, so they cannot be used as mongo keys.
+            "actions": [
+                {"action": act, "count": cnt} for act, cnt in self.actions.most_common()
+            ],
+            "mappings": self.mappings,
+            "continued": self.continued,
+            **self.extra,
+        }
+
+
+class SessionCorrelator:
+    """Keeps a bounded set of per-source sessions and emits them when they go idle.
+
+    Feed events by registering `observe` as a listener to the responders,
+    and start `run()` to periodically evict idle sessions into `queue`.
+    Call `flush()` on shutdown to emit the sessions still active.
+
+    Sessions lasting longer than `max_lifetime` seconds are emitted and continued
+    in a new session (marked as `continued`), which keeps the memory used by sources
+    never going idle bounded.
+    """
+
+    def __init__(
+        self,
+        queue=None,
+        idle_timeout=600,
+        max_lifetime=3600,
+        max_sessions=10000,
+        max_timeline=50,
+        max_actions=20,
+    ):
+        if queue is None:
+            queue = asyncio.Queue()
+        self.queue = queue
+        self.idle_timeout = timedelta(seconds=idle_timeout)
+        self.max_lifetime = timedelta(seconds=max_lifetime)
+        self.max_sessions = max_sessions
+        self.max_timeline = max_timeline
+        self.max_actions = max_actions
+        # ordered by last activity, the least recently active session first
+        self.sessions = OrderedDict()
+
+    def _emit(self, session):
+        self.queue.put_nowait(session.to_record())
+
+    def observe(self, kind, data):
+        """Add an event from a responder to the session of its source."""
+        if kind == "discovery":
+            srcip = data["ip"]
+            port = 1900
+            entry = {"type": "discovery"}
+        else:
+            srcip = data["srcip"]
+            port = data["dstport"]
+            entry = {"type": data["method"].lower(), "path": data["path"]}
+
+        if srcip is None:
+            return
+
+        ts = data.get("ts") or datetime.utcnow()
+
+        session = self.sessions.get(srcip)
+        if session is None:
+            session = Session(srcip, ts)
+            for field in ENRICHMENT_FIELDS:
+                if field in data:
+                    session.extra[field] = data[field]
+            self.sessions[srcip] = session
+            if len(self.sessions) > self.max_sessions:
+                _, oldest = self.sessions.popitem(last=False)
+                self._emit(oldest)
+        elif ts - session.start > self.max_lifetime:
+            self._emit(session)
+            extra = session.extra
+            session = Session(srcip, ts, continued=True)
+            session.extra = extra
+            del self.sessions[srcip]
+            self.sessions[srcip] = session
+        else:
+            self.sessions.move_to_end(srcip)
+
+        session.end = ts
+        session.events += 1
+        if port is not None:
+            session.ports.add(port)
+
+        if "soap_action" in data:
+            act = soap_action_name(data["soap_action"])
+            if act in session.actions or len(session.actions) < self.max_actions:
+                session.actions[act] += 1
+            else:
+                session.actions[OTHER_ACTIONS] += 1
+            entry["action"] = act
+            if act == "AddPortMapping" and len(session.mappings) < self.max_timeline:
+                args = parse_soap_args(data.get("body"))
+                mapping = {
+                    name: args[arg] for arg, name in MAPPING_ARGS.items() if arg in args
+                }
+                mapping["port"] = port
+                session.mappings.append(mapping)
+
+        if len(session.timeline) < self.max_timeline:
+            entry["ts"] = ts
+            entry["port"] = port
+            session.timeline.append(entry)
+
+    def evict_idle(self, now=None):
+        """Emit all sessions which have been idle for longer than the timeout."""
+        if now is None:
+            now = datetime.utcnow()
+        deadline = now - self.idle_timeout
+
+        evicted = 0
+        while self.sessions:
+            srcip, session = next(iter(self.sessions.items()))
+            if session.end > deadline:
+                break
+            del self.sessions[srcip]
+            self._emit(session)
+            evicted += 1
+
+        return evicted
+
+    def flush(self):
+        """Emit all sessions regardless of their activity."""
+        while self.sessions:
+            _, session = self.sessions.popitem(last=False)
+            self._emit(session)
+
+    async def run(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            _LOGGER.debug(
+                "Evicted %s idle sessions, %s active", evicted, len(self.sessions)
+            )
@@ -0,0 +1,315 @@
+"""
+Tag incoming events with origin AS and country from an offline prefix dataset.
+
+The dataset is a local tab (or comma) separated file, either in the iptoasn.com format
+    range_start  range_end  as_number  country_code  as_description
+or with a CIDR prefix in place of the range
+    prefix  as_number  country_code  [as_description]
+
+Lines starting with # are ignored, as are entries with AS number 0 ("not routed").
+Nested prefixes (as in pfx2as data) resolve to the most specific one, ranges that
+overlap without being nested are skipped when loading, like malformed lines.
+"""
+
+import asyncio
+import functools
+import ipaddress
+import logging
+import os
+import socket
+import time
+from array import array
+from bisect import bisect_right
+
+from cachetools import LRUCache
+
+_LOGGER = logging.getLogger(__name__)
+
+_ADDR_BITS = {4: 32, 6: 128}
+
+
+def _parse_addr(text):
+    """Return (version, integer value) of an address.
+
+    Avoids creating `ipaddress` objects, which dominate the loading time of large files.
+    """
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), "big")
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, text), "big")
+    except OSError:
+        raise ValueError("Invalid address: %s" % text)
+
+
+def _parse_line(line):
+    """Return (version, start, end, asn, country, name) for a dataset line, or None."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    sep = "\t" if "\t" in line else ","
+    fields = [f.strip() for f in line.split(sep)]
+
+    if "/" in fields[0]:
+        addr, _, length = fields[0].partition("/")
+        version, start = _parse_addr(addr)
+        host_bits = _ADDR_BITS[version] - int(length)
+        if not 0 <= host_bits <= _ADDR_BITS[version]:
+            raise ValueError("Invalid prefix length: %s" % fields[0])
+        start = start >> host_bits << host_bits
+        end = start | ((1 << host_bits) - 1)
+        rest = fields[1:]
+    else:
+        version, start = _parse_addr(fields[0])
+        end_version, end = _parse_addr(fields[1])
+        if version != end_version or start > end:
+            raise ValueError("Invalid range: %s-%s" % (fields[0], fields[1]))
+        rest = fields[2:]
+
+    asn = int(rest[0].upper().lstrip("AS"))
+    if asn == 0:
+        return None
+    country = rest[1] if len(rest) > 1 else ""
+    name = rest[2] if len(rest) > 2 else ""
+
+    return version, start, end, asn, country, name
+
+
+def _sorted_intervals(starts, ends, owners):
+    """Yield the (start, end, owner) intervals ordered by start, outer ones first.
+
+    Datasets are usually sorted already, in which case no copy is made."""
+    order = range(len(starts))
+    for i in range(len(starts) - 1):
+        if starts[i] > starts[i + 1] or (
+            starts[i] == starts[i + 1] and ends[i] < ends[i + 1]
+        ):
+            order = sorted(order, key=lambda i: (starts[i], -ends[i]))
+            break
+
+    for i in order:
+        yield starts[i], ends[i], owners[i]
+
+
+def _flatten(intervals, addr_cls):
+    """Split nested intervals into non-overlapping segments with the innermost owner.
+
+    Takes (start, end, owner) tuples ordered by start, outer intervals first for the
+    same start, and yields them so that each address maps to the most specific
+    interval covering it, i.e., the longest matching prefix.
+    Intervals overlapping without being nested cannot be resolved and are skipped.
+
+    >>> list(_flatten([(0, 255, "/24"), (0, 255, "dup"), (16, 31, "/28")], int))
+    [(0, 15, 'dup'), (16, 31, '/28'), (32, 255, 'dup')]
+    >>> list(_flatten([(0, 15, "a"), (8, 23, "b"), (16, 31, "c")], int))
+    [(0, 15, 'a'), (16, 31, 'c')]
+    """
+    stack = []  # (start, end, owner) of the intervals containing the current position
+    pos = None  # first address not yet emitted
+
+    for start, end, owner in intervals:
+        while stack and stack[-1][1] < start:
+            _, top_end, top_owner = stack.pop()
+            if pos <= top_end:
+                yield pos, top_end, top_owner
+                pos = top_end + 1
+
+        if stack:
+            top_start, top_end, top_owner = stack[-1]
+            if end > top_end:
+                _LOGGER.debug(
+                    "Skipping range %s-%s overlapping %s-%s",
+                    *map(addr_cls, (start, end, top_start, top_end))
+                )
+                continue
+            if pos < start:
+                yield pos, start - 1, top_owner
+
+        stack.append((start, end, owner))
+        pos = start
+
+    while stack:
+        _, top_end, top_owner = stack.pop()
+        if pos <= top_end:
+            yield pos, top_end, top_owner
+            pos = top_end + 1
+
+
+class _IntervalTable:
+    """Sorted, non-overlapping address intervals for a single address family.
+
+    Interval bounds and the indices of their metadata are stored in flat arrays
+    and searched with bisect."""
+
+    def __init__(self, starts, ends, owners, addr_cls, bounds_cls):
+        self.starts = bounds_cls()
+        self.ends = bounds_cls()
+        self.owners = array("I")
+        intervals = _sorted_intervals(starts, ends, owners)
+        for start, end, owner in _flatten(intervals, addr_cls):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.owners.append(owner)
+
+    def lookup(self, addr):
+        idx = bisect_right(self.starts, addr) - 1
+        if idx < 0 or addr > self.ends[idx]:
+            return None
+        return self.owners[idx]
+
+
+class _Index:
+    """Longest-prefix-match index over (possibly nested) prefixes or ranges.
+
+    The parsed entries are consumed one by one into flat arrays, so that a large
+    dataset is never held in memory as Python objects per line."""
+
+    def __init__(self, entries):
+        # Many prefixes share the same AS, keep only one copy of its metadata.
+        interned = {}
+        self.meta = []
+        v4_array = functools.partial(array, "I")
+        # IPv6 addresses do not fit into any array type, use plain lists of ints.
+        raw = {
+            4: (v4_array(), v4_array(), array("I")),
+            6: ([], [], array("I")),
+        }
+        self.entries = 0
+        for version, start, end, asn, country, name in entries:
+            key = (asn, country, name)
+            owner = interned.get(key)
+            if owner is None:
+                owner = interned[key] = len(self.meta)
+                self.meta.append(key)
+
+            starts, ends, owners = raw[version]
+            starts.append(start)
+            ends.append(end)
+            owners.append(owner)
+            self.entries += 1
+
+        self.v4 = _IntervalTable(*raw[4], ipaddress.IPv4Address, v4_array)
+        self.v6 = _IntervalTable(*raw[6], ipaddress.IPv6Address, list)
+
+    def __len__(self):
+        return self.entries
+
+    def lookup(self, ip):
+        addr = ipaddress.ip_address(ip)
+        if addr.version == 6 and addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+        table = self.v4 if addr.version == 4 else self.v6
+        owner = table.lookup(int(addr))
+        if owner is None:
+            return None
+        return self.meta[owner]
+
+
+class PrefixEnricher:
+    """Lookup origin AS information for source addresses.
+
+    The index is rebuilt in the background whenever the modification time of the dataset
+    changes, lookups keep using the previous index until the new one is swapped in.
+    Results for the most recently seen addresses are kept in an LRU cache.
+    """
+
+    def __init__(self, path, cache_size=10000, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self.cache = LRUCache(cache_size)
+        self._index = None
+        self._mtime = None
+        self._last_check = 0
+        self._reloading = False
+        self.reload()
+
+    def _entries(self):
+        """Yield the parsed entries of the dataset, skipping malformed lines."""
+        with open(self.path, encoding="utf-8", errors="replace") as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    entry = _parse_line(line)
+                except (ValueError, IndexError, KeyError) as ex:
+                    _LOGGER.debug("Skipping line %s of %s: %s", lineno, self.path, ex)
+                    continue
+                if entry is not None:
+                    yield entry
+
+    def _load(self):
+        """Parse the dataset into a new index, can be run in an executor."""
+        mtime = os.stat(self.path).st_mtime
+        start = time.time()
+        index = _Index(self._entries())
+        _LOGGER.info(
+            "Loaded %s prefixes from %s in %.2fs",
+            len(index),
+            self.path,
+            time.time() - start,
+        )
+        return index, mtime
+
+    def _swap(self, index, mtime):
+        self._index, self._mtime = index, mtime
+        self.cache.clear()
+
+    def reload(self):
+        """Load the dataset and swap it in as the active index."""
+        self._swap(*self._load())
+
+    async def _reload_in_background(self):
+        loop = asyncio.get_event_loop()
+        try:
+            self._swap(*await loop.run_in_executor(None, self._load))
+        except Exception as ex:
+            _LOGGER.error("Unable to reload %s: %s", self.path, ex)
+        finally:
+            self._reloading = False
+
+    def _check_for_update(self):
+        now = time.time()
+        if self._reloading or now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as ex:
+            _LOGGER.warning("Unable to stat %s: %s", self.path, ex)
+            return
+
+        if mtime != self._mtime:
+            _LOGGER.info("%s has changed, reloading", self.path)
+            self._reloading = True
+            asyncio.ensure_future(self._reload_in_background())
+
+    def lookup(self, ip):
+        """Return a dict of enrichment fields for the given address."""
+        self._check_for_update()
+        if ip is None:
+            return {}
+
+        try:
+            return self.cache[ip]
+        except KeyError:
+            pass
+
+        try:
+            meta = self._index.lookup(ip)
+        except ValueError:
+            meta = None
+
+        if meta is None:
+            res = {}
+        else:
+            asn, country, name = meta
+            res = {"asn": asn, "as_country": country, "as_name": name}
+
+        self.cache[ip] = res
+        return res
+
+    def enrich(self, data, ip_field):
+        """Add enrichment fields in-place to an event dict."""
+        data.update(self.lookup(data.get(ip_field)))
+        return data
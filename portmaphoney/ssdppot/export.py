@@ -0,0 +1,372 @@
+"""
+Export the collected data into day-partitioned parquet files.
+
+The documents are streamed from mongodb in batches and flattened into a fixed set of
+columns per collection, including the commonly seen headers and SOAP arguments.
+The remaining headers and arguments are kept as JSON strings.
+
+Documents are partitioned by the creation time of their ObjectId, which is also used
+as the checkpoint: each run exports the documents created between the previous bound
+and a bound `lag` seconds in the past. The lag leaves time for the documents still
+being inserted, as the ids are generated by the honeypot and not by mongodb.
+Files written by a run are only moved in place once all partitions have succeeded,
+and the checkpoint is advanced to the bound only after that.
+
+    <output>/<collection>/date=YYYY-MM-DD/part-<bound>.parquet
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from .common import parse_soap_args, soap_action_name
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, install with `pip install ssdppot[export]`
+    pa = pq = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# Headers stored in their own columns, the rest end up in headers_other
+HEADER_COLUMNS = ["host", "user-agent", "content-type", "content-length", "connection"]
+
+# Arguments of the IGD port mapping actions stored in their own columns
+SOAP_ARG_COLUMNS = [
+    "NewPortMappingIndex",
+    "NewRemoteHost",
+    "NewExternalPort",
+    "NewProtocol",
+    "NewInternalPort",
+    "NewInternalClient",
+    "NewEnabled",
+    "NewPortMappingDescription",
+    "NewLeaseDuration",
+]
+
+ENRICHMENT_COLUMNS = [("asn", "int64"), ("as_country", "string"), ("as_name", "string")]
+
+
+def _arg_column(name):
+    """NewExternalPort -> arg_external_port"""
+    return "arg" + re.sub("([A-Z])", r"_\1", name[3:]).lower()
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ts(doc):
+    ts = doc.get("ts")
+    if ts is None:
+        ts = doc["_id"].generation_time.replace(tzinfo=None)
+    return ts
+
+
+def _flatten_common(doc):
+    row = {"id": str(doc["_id"]), "ts": _ts(doc)}
+    for name, _ in ENRICHMENT_COLUMNS:
+        row[name] = doc.get(name)
+    return row
+
+
+def flatten_http(doc):
+    row = _flatten_common(doc)
+    row.update(
+        {
+            "srcip": doc.get("srcip"),
+            "srcport": _int(doc.get("srcport")),
+            "dstip": doc.get("dstip"),
+            "dstport": _int(doc.get("dstport")),
+            "method": doc.get("method"),
+            "path": doc.get("path"),
+            "soap_action": doc.get("soap_action"),
+            "action": None,
+            "error": doc.get("error"),
+            "body": doc.get("body"),
+            "no_action": bool(doc.get("no_action")),
+            "unsupported_action": bool(doc.get("unsupported_action")),
+            # only set in documents collected before the keyed mapping tables
+            "too_many_getmappings": bool(doc.get("too_many_getmappings")),
+            "end_of_list": bool(doc.get("end_of_list")),
+        }
+    )
+    if row["soap_action"]:
+        row["action"] = soap_action_name(row["soap_action"])
+
+    headers = {k.lower(): v for k, v in (doc.get("headers") or {}).items()}
+    for name in HEADER_COLUMNS:
+        row["header_" + name.replace("-", "_")] = headers.pop(name, None)
+    headers.pop("soapaction", None)
+    row["headers_other"] = json.dumps(headers, default=str) if headers else None
+
+    args = parse_soap_args(doc.get("body"))
+    for name in SOAP_ARG_COLUMNS:
+        row[_arg_column(name)] = args.pop(name, None)
+    row["args_other"] = json.dumps(args) if args else None
+
+    return row
+
+
+def flatten_discovery(doc):
+    request = doc.get("request")
+    if isinstance(request, bytes):  # base64 encoded when not parsed correctly
+        request = request.decode("ascii", errors="replace")
+
+    row = _flatten_common(doc)
+    row.update(
+        {
+            "ip": doc.get("ip"),
+            "src_port": _int(doc.get("src_port")),
+            "request": request,
+            "valid_request": bool(doc.get("valid_request")),
+            "too_many_tries": bool(doc.get("too_many_tries")),
+            "failed_to_parse": bool(doc.get("failed_to_parse")),
+        }
+    )
+    return row
+
+
+HTTP_COLUMNS = (
+    [("id", "string"), ("ts", "timestamp")]
+    + ENRICHMENT_COLUMNS
+    + [
+        ("srcip", "string"),
+        ("srcport", "int64"),
+        ("dstip", "string"),
+        ("dstport", "int64"),
+        ("method", "string"),
+        ("path", "string"),
+        ("soap_action", "string"),
+        ("action", "string"),
+        ("error", "string"),
+        ("body", "string"),
+        ("no_action", "bool"),
+        ("unsupported_action", "bool"),
+        ("too_many_getmappings", "bool"),
+        ("end_of_list", "bool"),
+    ]
+    + [("header_" + h.replace("-", "_"), "string") for h in HEADER_COLUMNS]
+    + [("headers_other", "string")]
+    + [(_arg_column(a), "string") for a in SOAP_ARG_COLUMNS]
+    + [("args_other", "string")]
+)
+
+DISCOVERY_COLUMNS = (
+    [("id", "string"), ("ts", "timestamp")]
+    + ENRICHMENT_COLUMNS
+    + [
+        ("ip", "string"),
+        ("src_port", "int64"),
+        ("request", "string"),
+        ("valid_request", "bool"),
+        ("too_many_tries", "bool"),
+        ("failed_to_parse", "bool"),
+    ]
+)
+
+COLLECTIONS = {
+    "http": (HTTP_COLUMNS, flatten_http),
+    "discoveries": (DISCOVERY_COLUMNS, flatten_discovery),
+}
+
+
+def _schema(columns):
+    types = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("ms"),
+    }
+    return pa.schema([(name, types[t]) for name, t in columns])
+
+
+def _partition_dir(output, collection, day):
+    return os.path.join(output, collection, "date=%s" % day.isoformat())
+
+
+class Exporter:
+    """Export the new documents of the given collections since the last checkpoint."""
+
+    def __init__(
+        self,
+        connstring,
+        database,
+        output,
+        checkpoint=None,
+        batch_size=10000,
+        workers=4,
+        compression="zstd",
+        lag=300,
+    ):
+        if pa is None:
+            raise RuntimeError("pyarrow is required for exporting")
+
+        self.db = MongoClient(connstring)[database]
+        self.output = output
+        if checkpoint is None:
+            checkpoint = os.path.join(output, "checkpoint.json")
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.workers = workers
+        self.compression = compression
+        self.lag = lag
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_checkpoint(self, state):
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.checkpoint)
+
+    def export_partition(self, collection, day, query, name):
+        """Write the documents of a single day into a temporary file.
+
+        Returns a (temporary path, final path, number of documents) tuple."""
+        columns, flatten = COLLECTIONS[collection]
+        schema = _schema(columns)
+
+        start = ObjectId.from_datetime(datetime.combine(day, time()))
+        end = ObjectId.from_datetime(datetime.combine(day + timedelta(days=1), time()))
+        query = dict(query)
+        query["$gte"] = max(query.get("$gte", start), start)
+        query["$lt"] = min(query.get("$lt", end), end)
+
+        outdir = _partition_dir(self.output, collection, day)
+        os.makedirs(outdir, exist_ok=True)
+        path = os.path.join(outdir, name)
+        tmp = path + ".tmp"
+
+        cursor = (
+            self.db[collection]
+            .find({"_id": query})
+            .sort("_id", 1)
+            .batch_size(self.batch_size)
+        )
+
+        count = 0
+        rows = []
+        with pq.ParquetWriter(tmp, schema, compression=self.compression) as writer:
+            for doc in cursor:
+                rows.append(flatten(doc))
+                if len(rows) >= self.batch_size:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    count += len(rows)
+                    rows.clear()
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                count += len(rows)
+
+        _LOGGER.info("Exported %s documents from %s for %s", count, collection, day)
+        return tmp, path, count
+
+    def export(self, collection):
+        """Export the new documents of a collection, returns the number of documents."""
+        state = self.read_checkpoint()
+        coll = self.db[collection]
+
+        bound = ObjectId.from_datetime(
+            datetime.now(timezone.utc) - timedelta(seconds=self.lag)
+        )
+        query = {"$lt": bound}
+        if collection in state:
+            query["$gte"] = ObjectId(state[collection])
+
+        oldest = coll.find_one({"_id": query}, sort=[("_id", 1)], projection=[])
+        if oldest is None:
+            _LOGGER.info("No new documents in %s", collection)
+            return 0
+        newest = coll.find_one({"_id": query}, sort=[("_id", -1)], projection=[])
+        first_day = oldest["_id"].generation_time.date()
+        last_day = newest["_id"].generation_time.date()
+        days = [
+            first_day + timedelta(days=i)
+            for i in range((last_day - first_day).days + 1)
+        ]
+
+        name = "part-%s.parquet" % bound
+        _LOGGER.info(
+            "Exporting %s from %s to %s (%s partitions)",
+            collection,
+            first_day,
+            last_day,
+            len(days),
+        )
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit(self.export_partition, collection, day, query, name)
+                for day in days
+            ]
+            results = []
+            failed = None
+            for fut in futures:
+                try:
+                    results.append(fut.result())
+                except Exception as ex:
+                    failed = ex
+
+        if failed is not None:
+            for tmp in glob.glob(
+                os.path.join(self.output, collection, "date=*", name + ".tmp")
+            ):
+                os.remove(tmp)
+            raise failed
+
+        total = 0
+        for tmp, path, count in results:
+            if count:
+                os.replace(tmp, path)
+            else:
+                os.remove(tmp)
+            total += count
+
+        state[collection] = str(bound)
+        self.write_checkpoint(state)
+        return total
+
+    def compact(self, collection):
+        """Merge the part files of each partition into one, returns the merged count."""
+        merged = 0
+        for outdir in sorted(
+            glob.glob(os.path.join(self.output, collection, "date=*"))
+        ):
+            parts = sorted(glob.glob(os.path.join(outdir, "part-*.parquet")))
+            if len(parts) < 2:
+                continue
+
+            # the newest part name is kept, so that the files stay ordered by their ids
+            path = parts[-1]
+            tmp = path + ".tmp"
+            schema = pq.read_schema(path)
+            with pq.ParquetWriter(tmp, schema, compression=self.compression) as writer:
+                for part in parts:
+                    for batch in pq.ParquetFile(part).iter_batches(self.batch_size):
+                        writer.write_batch(batch)
+
+            # replacing first may leave duplicates on failure, but never loses data
+            os.replace(tmp, path)
+            for part in parts[:-1]:
+                os.remove(part)
+
+            _LOGGER.info("Compacted %s files in %s", len(parts), outdir)
+            merged += 1
+
+        return merged
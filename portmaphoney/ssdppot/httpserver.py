@@ -1,39 +1,88 @@
 import asyncio
 import logging
-import random
+import os
+import time
 from collections import Counter
+from datetime import datetime
 
 import click
 from aiohttp import web
-from cachetools import TTLCache
 from motor.motor_asyncio import AsyncIOMotorClient
 from tqdm import tqdm
 
-from .common import TqdmHandler, generic_mongo_batch_inserter
+from .common import (
+    TqdmHandler,
+    generic_mongo_batch_inserter,
+    parse_soap_args,
+    soap_action_name,
+)
 from .const import *
+from .correlator import SessionCorrelator
+from .enrich import PrefixEnricher
+from .export import COLLECTIONS, Exporter
+from .limits import SHED_POLICIES, AdmissionControl, Limits
+from .mapping import MappingTable
 from .multiapp import MultiApp
-from .udpserver import start_server
+from .stats import SharedStats, StatsReader
+from .stream import EventStream
+from .udpserver import UDP_COUNTERS, start_server
 
 _LOGGER = logging.getLogger(__name__)
 
+# Counters registered up front, so that they always get a slot in the stats file
+HTTP_COUNTERS = [
+    "posts_seen",
+    "scds_requested",
+    "end_of_list",
+    "events_shed",
+    "body_too_large",
+    "body_timeouts",
+    "rejected_connections",
+    "rejected_source_connections",
+    "header_timeouts",
+    "keepalive_closed",
+    "stream_dropped_subscribers",
+    OTHER_ACTIONS,
+] + IGD_ACTIONS
+
 
 class HTTPResponder:
-    def __init__(self, stats=None):
-        self.queue = asyncio.Queue()
+    def __init__(
+        self, stats=None, enricher=None, listeners=None, limits=None, mappings=None
+    ):
+        if limits is None:
+            limits = Limits()
+        self.limits = limits
+        self.queue = asyncio.Queue(maxsize=limits.max_queue_size)
         loop = asyncio.get_event_loop()
         if stats is None:
             stats = Counter()
         self.stats = stats
+        self.admission = AdmissionControl(limits, stats)
+        self.enricher = enricher
+        if listeners is None:
+            listeners = []
+        self.listeners = listeners
 
-        self.addr_cache = TTLCache(1000, 600)
+        if mappings is None:
+            mappings = MappingTable()
+        self.mappings = mappings
 
         self.ma = MultiApp(loop=loop)
         for port in set(HTTP_PORTS):
-            app = web.Application(middlewares=[self.error_middleware])
+            app = web.Application(
+                middlewares=[self.admission.middleware, self.error_middleware],
+                client_max_size=limits.max_body_size,
+            )
             scd_routes = [web.get(path, self.return_scd) for path in SCD_PATHS]
             post_routes = [web.post(path, self.handle_post) for path in CTL_PATHS]
 
-            self.ma.configure_app(app, port=port)
+            self.ma.configure_app(
+                app,
+                port=port,
+                runner_kwargs={"keepalive_timeout": limits.header_timeout},
+                server_wrapper=self.admission.wrap,
+            )
             _LOGGER.info("Listening on port: %s" % port)
             app.add_routes(scd_routes + post_routes)
 
@@ -41,21 +90,52 @@ class HTTPResponder:
         """Call multiapp to run forever."""
         self.ma.run_all()
 
-    def return_port_mapping(self, req, data):
-        self.queue.put_nowait(data)
-        d = {
-            "external_port": random.randint(30000, 60000),
-            "internal_port": random.randint(1024, 65535),
-            "protocol": "TCP",
-        }
+    def push(self, data):
+        """Pass the request data to the listeners and queue it for storing."""
+        for listener in self.listeners:
+            try:
+                listener("http", data)
+            except Exception as ex:
+                _LOGGER.error("Listener %s failed: %s", listener, ex, exc_info=True)
+
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.stats["events_shed"] += 1
+            if self.limits.shed_policy == "drop-oldest":
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.queue.put_nowait(data)
+
+    async def read_body(self, req):
+        """Read the request body as text within the configured limits.
+
+        Returns a tuple of (text, error), text is None if reading failed."""
+        if (req.content_length or 0) > self.limits.max_body_size:
+            self.stats["body_too_large"] += 1
+            return None, "body too large"
+
+        try:
+            text = await asyncio.wait_for(req.text(), timeout=self.limits.body_timeout)
+        except asyncio.TimeoutError:
+            self.stats["body_timeouts"] += 1
+            return None, "body timeout"
+        except web.HTTPRequestEntityTooLarge:
+            self.stats["body_too_large"] += 1
+            return None, "body too large"
+
+        return text, None
+
+    def return_port_mapping(self, req, data, entry):
+        self.push(data)
         return web.Response(
             status=200,
             headers=SSDP_MAPPING_HEADERS,
-            body=SSDP_MAPPING_RESPONSE.substitute(d),
+            body=SSDP_MAPPING_RESPONSE.substitute(entry),
         )
 
     def add_port_mapping(self, req, data):
-        self.queue.put_nowait(data)
+        self.push(data)
         if "AddPortMapping" in data["body"]:
             return web.Response(
                 status=200,
@@ -67,7 +147,7 @@ class HTTPResponder:
             return web.Response(status=400, headers=err_headers)
 
     def return_end_of_list(self, req, data):
-        self.queue.put_nowait(data)
+        self.push(data)
         return web.Response(status=500, headers=ERROR_HEADERS, body=SSDP_MAPPING_END)
 
     def get_data_from_req(self, req):
@@ -88,13 +168,17 @@ class HTTPResponder:
             "srcport": port,
             "dstport": dstport,
             "dstip": dstip,
+            "ts": datetime.utcnow(),
         }
+        if self.enricher is not None:
+            self.enricher.enrich(data, "srcip")
+
         return data
 
     async def handle_post(self, req: web.Request):
         def return_error(data, error):
             data["error"] = error
-            self.queue.put_nowait(data)
+            self.push(data)
             return web.Response(status=500)
 
         data = self.get_data_from_req(req)
@@ -103,15 +187,16 @@ class HTTPResponder:
 
         self.stats["posts_seen"] += 1
 
-        text = await req.text()
+        text, error = await self.read_body(req)
+        if error is not None:
+            _LOGGER.debug("<< POST %s rejected: %s", data["srcip"], error)
+            return return_error(data, error)
+
         _LOGGER.debug("POST called: %s" % text)
         data["body"] = text
 
         srcip = data["srcip"]
         dstport = data["dstport"]
-        addr_cache_key = (srcip, dstport)
-        if addr_cache_key not in self.addr_cache:
-            self.addr_cache[addr_cache_key] = 0
 
         if "SOAPACTION" not in req.headers:
             data["no_action"] = True
@@ -120,17 +205,24 @@ class HTTPResponder:
         else:
             act = req.headers["SOAPACTION"]
             _LOGGER.info("<< POST %s on %s - soapaction: %s", srcip, dstport, act)
-            self.stats[act] += 1
+            name = soap_action_name(act)
+            if name not in IGD_ACTIONS:
+                name = OTHER_ACTIONS
+            self.stats[name] += 1
             data["soap_action"] = act
 
             if "GetGenericPortMappingEntry" in act:
-                self.addr_cache[addr_cache_key] += 1
-                if self.addr_cache[addr_cache_key] > 5:
-                    data["too_many_getmappings"] = True
-                    self.stats["too_many_getmappings"] += 1
+                entry = None
+                index = parse_soap_args(text).get("NewPortMappingIndex", "")
+                if index.strip().isdigit():
+                    entry = self.mappings.entry(srcip, dstport, int(index))
+
+                if entry is None:
+                    data["end_of_list"] = True
+                    self.stats["end_of_list"] += 1
                     return self.return_end_of_list(req, data)
 
-                return self.return_port_mapping(req, data)
+                return self.return_port_mapping(req, data, entry)
             elif "AddPortMapping" in act:
                 return self.add_port_mapping(req, data)
             else:
@@ -141,9 +233,13 @@ class HTTPResponder:
         self.stats["scds_requested"] += 1
         data = self.get_data_from_req(req)
 
-        self.queue.put_nowait(data)
+        self.push(data)
+
+        data["body"], error = await self.read_body(req)
+        if error is not None:
+            data["error"] = error
+            return web.Response(status=500)
 
-        data["body"] = await req.text()
         return web.Response(body=SSDP_WEB_RESPONSE, headers=SSDP_WEB_HEADERS)
 
     @web.middleware
@@ -200,11 +296,207 @@ def tcpdump(ip, full, interface):
     click.echo(cmd)
 
 
+def print_stats(path, pid, counters, prev_counters, elapsed):
+    click.echo(f"== {path} (pid {pid})")
+    for name, value in sorted(counters.items()):
+        delta = value - prev_counters.get(name, 0)
+        rate = delta / elapsed if elapsed > 0 else 0
+        click.echo(f"{name:<60} {value:>12} {delta:>+10} {rate:>10.2f}/s")
+
+
+@cli.command()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("-w", "--watch", type=float, help="Keep printing every N seconds")
+def stats(files, watch):
+    """Print counters from the stats files of a running honeypot
+
+    Without --watch, the deltas and rates are since the start of the honeypot."""
+    readers = {}
+    for path in files:
+        try:
+            readers[path] = StatsReader(path)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex))
+
+    prev = {}
+    while True:
+        now = time.time()
+        for path, reader in readers.items():
+            pid, created, counters = reader.snapshot()
+            prev_created, prev_ts, prev_counters = prev.get(path, (None, None, {}))
+            if prev_created != created:  # first round or the honeypot was restarted
+                prev_ts, prev_counters = created, {}
+            print_stats(path, pid, counters, prev_counters, now - prev_ts)
+            prev[path] = created, now, counters
+
+        if watch is None:
+            break
+        time.sleep(watch)
+        click.echo()
+
+
+@cli.command()
+@click.option("--connstring", default="mongodb://localhost")
+@click.option("--database", default="ssdppot")
+@click.option(
+    "--collection",
+    "collections",
+    type=click.Choice(list(COLLECTIONS)),
+    multiple=True,
+    default=list(COLLECTIONS),
+    show_default=True,
+)
+@click.option("-o", "--output", required=True, type=click.Path(file_okay=False))
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="Checkpoint file [default: OUTPUT/checkpoint.json]",
+)
+@click.option("--batch-size", default=10000, show_default=True)
+@click.option(
+    "--workers",
+    default=4,
+    show_default=True,
+    help="Number of partitions exported in parallel",
+)
+@click.option(
+    "--lag",
+    default=300,
+    show_default=True,
+    help="Seconds to leave for documents still being inserted",
+)
+@click.option("--compact", is_flag=True, help="Merge the files of each partition")
+@click.option("-d", "--debug", is_flag=True)
+def export(
+    connstring,
+    database,
+    collections,
+    output,
+    checkpoint,
+    batch_size,
+    workers,
+    lag,
+    compact,
+    debug,
+):
+    """Export new documents into day-partitioned parquet files"""
+    lvl = logging.INFO
+    if debug:
+        lvl = logging.DEBUG
+    logging.basicConfig(level=lvl, format="%(asctime)s %(levelname)s - %(message)s")
+
+    try:
+        exporter = Exporter(
+            connstring,
+            database,
+            output,
+            checkpoint=checkpoint,
+            batch_size=batch_size,
+            workers=workers,
+            lag=lag,
+        )
+    except RuntimeError as ex:
+        raise click.ClickException(f"{ex}, install with `pip install ssdppot[export]`")
+
+    for collection in collections:
+        count = exporter.export(collection)
+        click.echo(f"{collection}: exported {count} documents")
+        if compact:
+            merged = exporter.compact(collection)
+            click.echo(f"{collection}: compacted {merged} partitions")
+
+
 @cli.command()
 @click.option("--connstring", default="mongodb://localhost")
 @click.option("--database", default="ssdppot")
+@click.option(
+    "--prefix-db",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Prefix to ASN/country dataset for tagging the sources",
+)
+@click.option(
+    "--session-timeout",
+    default=600,
+    show_default=True,
+    help="Seconds of inactivity after which a source's session is stored",
+)
+@click.option(
+    "--session-lifetime",
+    default=3600,
+    show_default=True,
+    help="Seconds after which an active session is stored and continued in a new one",
+)
+@click.option(
+    "--stats-dir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    help="Directory for the stats files readable with `ssdppot stats`",
+)
+@click.option("--max-connections", default=1000, show_default=True)
+@click.option("--max-connections-per-source", default=10, show_default=True)
+@click.option(
+    "--header-timeout",
+    default=10.0,
+    show_default=True,
+    help="Seconds to wait for the request headers",
+)
+@click.option(
+    "--body-timeout",
+    default=10.0,
+    show_default=True,
+    help="Seconds to wait for the request body",
+)
+@click.option("--max-body-size", default=64 * 1024, show_default=True, help="In bytes")
+@click.option(
+    "--max-queue-size",
+    default=10000,
+    show_default=True,
+    help="Maximum number of events waiting to be stored",
+)
+@click.option(
+    "--shed-policy",
+    type=click.Choice(SHED_POLICIES),
+    default="drop-newest",
+    show_default=True,
+    help="Which events to drop when the queue is full",
+)
+@click.option(
+    "--persona",
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON file with the key and settings for the fake port mappings",
+)
+@click.option(
+    "--stream-port",
+    type=int,
+    help="Serve the live event stream (server-sent events) on this port",
+)
+@click.option("--stream-host", default="127.0.0.1", show_default=True)
+@click.option(
+    "--stream-buffer",
+    default=100,
+    show_default=True,
+    help="Events buffered per stream subscriber before dropping it",
+)
 @click.option("-d", "--debug", is_flag=True)
-def run(connstring, database, debug):
+def run(
+    connstring,
+    database,
+    prefix_db,
+    session_timeout,
+    session_lifetime,
+    stats_dir,
+    max_connections,
+    max_connections_per_source,
+    header_timeout,
+    body_timeout,
+    max_body_size,
+    max_queue_size,
+    shed_policy,
+    persona,
+    stream_port,
+    stream_host,
+    stream_buffer,
+    debug,
+):
     """Start the honeypot"""
     lvl = logging.INFO
     if debug:
@@ -238,21 +530,89 @@ def run(connstring, database, debug):
     db = client[database]
     coll = db["http"]
 
+    mappings = MappingTable()
+    if persona is not None:
+        try:
+            mappings = MappingTable.from_persona(persona)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint="--persona")
+
+    enricher = None
+    if prefix_db is not None:
+        enricher = PrefixEnricher(prefix_db)
+
+    # correlate the events from both servers into sessions
+    correlator = SessionCorrelator(
+        idle_timeout=session_timeout, max_lifetime=session_lifetime
+    )
+    listeners = [correlator.observe]
+    asyncio.ensure_future(correlator.run())
+    sessions_inserter = asyncio.ensure_future(
+        generic_mongo_batch_inserter(correlator.queue, db["sessions"])
+    )
+
     # start udp server
-    udp_stats = Counter()  # need to pass separately...
-    udp = start_server(connstring, database, udp_stats)
+    if stats_dir is not None:
+        udp_stats = SharedStats(
+            os.path.join(stats_dir, "udp.stats"), counters=UDP_COUNTERS
+        )
+        http_stats = SharedStats(
+            os.path.join(stats_dir, "http.stats"), counters=HTTP_COUNTERS
+        )
+    else:
+        udp_stats = Counter()  # need to pass separately...
+        http_stats = Counter()
+
+    if stream_port is not None:
+        stream = EventStream(buffer_size=stream_buffer, stats=http_stats)
+        listeners.append(stream.publish)
+
+    udp = start_server(connstring, database, udp_stats, enricher, listeners=listeners)
     asyncio.ensure_future(udp)
     udp_bar = tqdm(desc="UDP", position=0, total=0)
 
     # start http server and mongoinsert
-    http_stats = Counter()
-    http = HTTPResponder(http_stats)
+    limits = Limits(
+        max_connections=max_connections,
+        max_connections_per_source=max_connections_per_source,
+        header_timeout=header_timeout,
+        body_timeout=body_timeout,
+        max_body_size=max_body_size,
+        max_queue_size=max_queue_size,
+        shed_policy=shed_policy,
+    )
+    http = HTTPResponder(
+        http_stats,
+        enricher,
+        listeners=listeners,
+        limits=limits,
+        mappings=mappings,
+    )
     http_bar = tqdm(desc="HTTP", position=1, total=0)
     # Need to initialize before http.run to keep updating
     asyncio.ensure_future(update_stats(udp_bar, udp_stats, http_bar, http_stats))
 
-    asyncio.ensure_future(generic_mongo_batch_inserter(http.queue, coll))
-    asyncio.ensure_future(http.run())
+    if stream_port is not None:
+        http.ma.configure_app(stream.make_app(), port=stream_port, hosts=[stream_host])
+        _LOGGER.info("Event stream on http://%s:%s/events", stream_host, stream_port)
+
+    http_inserter = asyncio.ensure_future(
+        generic_mongo_batch_inserter(http.queue, coll)
+    )
+    try:
+        http.run()
+    finally:
+        # store the sessions still active and the buffered entries when shutting down
+        correlator.flush()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            asyncio.gather(
+                http.queue.put(None),
+                correlator.queue.put(None),
+                http_inserter,
+                sessions_inserter,
+            )
+        )
 
 
 if __name__ == "__main__":
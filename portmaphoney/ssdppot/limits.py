@@ -0,0 +1,208 @@
+"""
+Admission control and slow-client protection for the SOAP listeners.
+
+The connection limits and header deadlines are enforced by wrapping the protocol factory
+of the aiohttp servers, so that excess connections are dropped before aiohttp creates
+its request handler for them. The header deadline is paused by `AdmissionControl.middleware`
+while a request is being handled, and idle kept-alive connections are left to the
+`keepalive_timeout` of aiohttp. The body sizes and deadlines are enforced
+by `HTTPResponder` itself.
+"""
+
+import asyncio
+import logging
+from collections import Counter
+
+from aiohttp import web
+
+_LOGGER = logging.getLogger(__name__)
+
+SHED_POLICIES = ["drop-newest", "drop-oldest"]
+
+
+class Limits:
+    """Resource limits for the SOAP listeners.
+
+    :param max_connections: concurrent connections over all ports
+    :param max_connections_per_source: concurrent connections per source address
+    :param header_timeout: seconds to wait for the request headers
+    :param body_timeout: seconds to wait for the request body
+    :param max_body_size: maximum accepted request body in bytes
+    :param max_queue_size: maximum number of events waiting to be stored
+    :param shed_policy: which events to drop when the event queue is full
+    """
+
+    def __init__(
+        self,
+        max_connections=1000,
+        max_connections_per_source=10,
+        header_timeout=10,
+        body_timeout=10,
+        max_body_size=64 * 1024,
+        max_queue_size=10000,
+        shed_policy="drop-newest",
+    ):
+        if shed_policy not in SHED_POLICIES:
+            raise ValueError("Unknown shed policy: %s" % shed_policy)
+
+        self.max_connections = max_connections
+        self.max_connections_per_source = max_connections_per_source
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_body_size = max_body_size
+        self.max_queue_size = max_queue_size
+        self.shed_policy = shed_policy
+
+
+class AdmissionControl:
+    """Tracks the open connections and decides which new ones are accepted."""
+
+    def __init__(self, limits, stats):
+        self.limits = limits
+        self.stats = stats
+        self.total = 0
+        self.per_source = Counter()
+        # transport -> _GuardedProtocol of the admitted connections
+        self.guards = {}
+
+    def admit(self, host):
+        if self.total >= self.limits.max_connections:
+            self.stats["rejected_connections"] += 1
+            _LOGGER.debug("Rejecting %s: global connection limit reached", host)
+            return False
+
+        if self.per_source[host] >= self.limits.max_connections_per_source:
+            self.stats["rejected_source_connections"] += 1
+            _LOGGER.debug("Rejecting %s: too many connections from source", host)
+            return False
+
+        self.total += 1
+        self.per_source[host] += 1
+        return True
+
+    def release(self, host):
+        self.total -= 1
+        self.per_source[host] -= 1
+        if self.per_source[host] <= 0:
+            del self.per_source[host]
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """Pause the header deadline of the connection while handling a request."""
+        guard = self.guards.get(request.transport)
+        if guard is None:
+            return await handler(request)
+
+        guard.request_started()
+        try:
+            return await handler(request)
+        finally:
+            guard.request_finished(request.keep_alive)
+
+    def wrap(self, server):
+        """Wrap an aiohttp server (protocol factory) to pass through this."""
+        return _GuardedServer(self, server)
+
+
+class _GuardedServer:
+    """Protocol factory admitting connections before handing them to aiohttp.
+
+    Everything else is delegated to the wrapped `aiohttp.web_server.Server`."""
+
+    def __init__(self, admission, server):
+        self._admission = admission
+        self._server = server
+
+    def __call__(self):
+        return _GuardedProtocol(self._admission, self._server)
+
+    def __getattr__(self, name):
+        return getattr(self._server, name)
+
+
+class _GuardedProtocol(asyncio.Protocol):
+    """Proxy protocol enforcing the connection limits and header deadlines.
+
+    The aiohttp protocol is only created once the connection has been admitted.
+    After a request has been handled, the deadline is re-armed only when the first
+    bytes of the next request arrive, so idle kept-alive connections are not counted
+    as header timeouts.
+    """
+
+    def __init__(self, admission, protocol_factory):
+        self._admission = admission
+        self._protocol_factory = protocol_factory
+        self._protocol = None
+        self._transport = None
+        self._host = None
+        self._deadline = None
+        # a request has been handled and no bytes of the next one have arrived
+        self._idle = False
+
+    def _arm_deadline(self, timeout):
+        self._cancel_deadline()
+        loop = asyncio.get_event_loop()
+        self._deadline = loop.call_later(timeout, self._deadline_expired)
+
+    def _deadline_expired(self):
+        self._deadline = None
+        self._admission.stats["header_timeouts"] += 1
+        _LOGGER.debug("Closing connection from %s: header timeout", self._host)
+        self._transport.abort()
+
+    def _cancel_deadline(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def request_started(self):
+        """Called when the headers of a request have been parsed."""
+        self._idle = False
+        self._cancel_deadline()
+
+    def request_finished(self, keep_alive=True):
+        """Called when a request has been handled, waiting for the next one."""
+        self._idle = keep_alive
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info("peername")
+        if peername is not None:
+            self._host = peername[0]
+
+        if not self._admission.admit(self._host):
+            transport.abort()
+            return
+
+        self._transport = transport
+        self._admission.guards[transport] = self
+        self._arm_deadline(self._admission.limits.header_timeout)
+        self._protocol = self._protocol_factory()
+        self._protocol.connection_made(transport)
+
+    def data_received(self, data):
+        if self._idle:
+            self._idle = False
+            self._arm_deadline(self._admission.limits.header_timeout)
+        self._protocol.data_received(data)
+
+    def eof_received(self):
+        if self._protocol is not None:
+            return self._protocol.eof_received()
+
+    def connection_lost(self, exc):
+        if self._transport is None:
+            return
+
+        if self._idle:
+            self._admission.stats["keepalive_closed"] += 1
+        self._cancel_deadline()
+        del self._admission.guards[self._transport]
+        self._transport = None
+        self._admission.release(self._host)
+        self._protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        self._protocol.pause_writing()
+
+    def resume_writing(self):
+        self._protocol.resume_writing()
@@ -0,0 +1,126 @@
+"""
+Fake port mapping tables derived from a keyed hash instead of per-client state.
+
+Every (source, port, index) triple is hashed with a secret key, so that repeated
+enumerations from the same client return the same table ending at the same index,
+while different clients and different honeypots (with different keys) see different ones.
+
+The key and the look of the entries can be pinned with a JSON persona file, e.g.:
+
+    {
+        "key": "some secret",
+        "internal_network": "192.168.1.0/24",
+        "descriptions": ["uTorrent", "Skype", "WhatsApp"],
+        "min_entries": 2,
+        "max_entries": 8
+    }
+"""
+
+import hashlib
+import ipaddress
+import json
+import os
+
+DEFAULT_DESCRIPTIONS = [
+    "mTorrent",
+    "uTorrent",
+    "Skype",
+    "BitTorrent",
+    "Teredo",
+    "WhatsApp",
+    "PS4",
+    "Xbox",
+]
+
+PROTOCOLS = ["TCP", "UDP"]
+
+
+class MappingTable:
+    """Stateless generator for the GetGenericPortMappingEntry responses."""
+
+    def __init__(
+        self,
+        key=None,
+        internal_network="192.168.0.0/24",
+        descriptions=None,
+        min_entries=1,
+        max_entries=5,
+    ):
+        if key is None:
+            key = os.urandom(16)
+        elif isinstance(key, str):
+            key = key.encode()
+        # blake2b accepts at most 64 byte keys
+        self.key = hashlib.blake2b(key).digest()
+
+        network = ipaddress.ip_network(internal_network)
+        if network.num_addresses < 4:
+            raise ValueError(
+                "Internal network too small, at least a /30 is needed: %s" % network
+            )
+        # skip the network address, the gateway (.1) and the broadcast address
+        self.first_host = int(network.network_address) + 2
+        self.num_hosts = network.num_addresses - 3
+
+        if descriptions is None:
+            descriptions = DEFAULT_DESCRIPTIONS
+        if (
+            not isinstance(descriptions, list)
+            or not descriptions
+            or not all(isinstance(d, str) for d in descriptions)
+        ):
+            raise ValueError("Descriptions must be a non-empty list of strings")
+        self.descriptions = descriptions
+        if not 0 <= min_entries <= max_entries:
+            raise ValueError(
+                "Invalid number of entries: %s-%s" % (min_entries, max_entries)
+            )
+        self.min_entries = min_entries
+        self.max_entries = max_entries
+
+    @classmethod
+    def from_persona(cls, path):
+        """Create a table from a persona file, raises ValueError for invalid ones."""
+        try:
+            with open(path) as f:
+                persona = json.load(f)
+            return cls(**persona)
+        except (TypeError, ValueError) as ex:  # JSONDecodeError is a ValueError
+            raise ValueError("Invalid persona %s: %s" % (path, ex))
+
+    def _hash(self, *parts):
+        data = "|".join(map(str, parts)).encode()
+        return int.from_bytes(hashlib.blake2b(data, key=self.key).digest(), "big")
+
+    def size(self, srcip, port):
+        """Return the number of entries in the table of the client."""
+        span = self.max_entries - self.min_entries + 1
+        return self.min_entries + self._hash(srcip, port, "size") % span
+
+    def entry(self, srcip, port, index):
+        """Return the template variables for an entry, None for out of range indices."""
+        if index < 0 or index >= self.size(srcip, port):
+            return None
+
+        h = self._hash(srcip, port, index)
+        h, protocol = divmod(h, len(PROTOCOLS))
+        h, description = divmod(h, len(self.descriptions))
+        h, host = divmod(h, self.num_hosts)
+        h, internal_port = divmod(h, 65535 - 1024)
+        h, same_port = divmod(h, 2)
+        h, external_port = divmod(h, 60000 - 30000)
+
+        internal_port += 1024
+        if same_port:
+            external_port = internal_port
+        else:
+            external_port += 30000
+
+        protocol = PROTOCOLS[protocol]
+        return {
+            "external_port": external_port,
+            "internal_port": internal_port,
+            "internal_client": str(ipaddress.ip_address(self.first_host + host)),
+            "protocol": protocol,
+            "description": "%s (%s)" % (self.descriptions[description], protocol),
+        }
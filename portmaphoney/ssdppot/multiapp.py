@@ -14,18 +14,33 @@ _LOGGER = logging.getLogger(__name__)
 
 
 class AppWrapper:
-    def __init__(self, aioapp, port, ssl_context, loop):
+    def __init__(
+        self,
+        aioapp,
+        port,
+        ssl_context,
+        loop,
+        runner_kwargs=None,
+        server_wrapper=None,
+        hosts=None,
+    ):
         self.port = port
+        self.hosts = hosts or ["::", "0.0.0.0"]
         self.aioapp = aioapp
         self.loop = loop
         self.ssl_context = ssl_context
+        self.runner_kwargs = runner_kwargs or {}
+        self.server_wrapper = server_wrapper
         self.runner = None
 
     def initialize(self):
-        self.runner = web_runner.AppRunner(self.aioapp)
+        self.runner = web_runner.AppRunner(self.aioapp, **self.runner_kwargs)
 
         self.loop.run_until_complete(self.runner.setup())
-        for host in ["::", "0.0.0.0"]:
+        if self.server_wrapper is not None:
+            # the sites create their listeners from runner.server, which is read-only
+            self.runner._server = self.server_wrapper(self.runner._server)
+        for host in self.hosts:
             site = web_runner.TCPSite(
                 self.runner, host=host, port=self.port, ssl_context=self.ssl_context
             )
@@ -54,9 +69,32 @@ class MultiApp:
         else:
             self.loop = loop
 
-    def configure_app(self, app, port, ssl_context=None):
+    def configure_app(
+        self,
+        app,
+        port,
+        ssl_context=None,
+        runner_kwargs=None,
+        server_wrapper=None,
+        hosts=None,
+    ):
+        """Add an app to be run on the given port.
+
+        `runner_kwargs` are passed to the AppRunner (and further to the request handlers),
+        `server_wrapper` is called with the created server to allow wrapping it.
+        `hosts` defaults to listening on all IPv4 and IPv6 addresses."""
         app._set_loop(self.loop)
-        self._apps.append(AppWrapper(app, port, ssl_context, self.loop))
+        self._apps.append(
+            AppWrapper(
+                app,
+                port,
+                ssl_context,
+                self.loop,
+                runner_kwargs,
+                server_wrapper,
+                hosts,
+            )
+        )
 
     def run_all(self):
         _LOGGER.info("Initializing %s apps", len(self._apps))
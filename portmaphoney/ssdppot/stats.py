@@ -0,0 +1,174 @@
+"""
+Counters kept in a memory-mapped file for reading them from other processes.
+
+The file consists of a fixed header followed by a fixed number of slots:
+
+    header: magic (8s), version (I), slot count (I), used slots (I), pid (I), created (d)
+    slot:   name (56s, utf-8, NUL padded), value (Q)
+
+Updating a counter is a plain write into the mapping, so no syscalls are involved.
+New names are written into the next free slot before the used slot count is bumped,
+so readers never see a half-initialized slot.
+"""
+
+import mmap
+import os
+import struct
+import time
+from collections.abc import MutableMapping
+
+MAGIC = b"SSDPSTAT"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIIId")
+HEADER_SIZE = 64
+NAME_SIZE = 56
+SLOT = struct.Struct("<%dsQ" % NAME_SIZE)
+VALUE = struct.Struct("<Q")
+USED = struct.Struct("<I")
+USED_OFFSET = 16
+
+OVERFLOW = "_overflow"
+
+
+def _slot_offset(idx):
+    return HEADER_SIZE + idx * SLOT.size
+
+
+def _encode_name(name):
+    return str(name).encode("utf-8", errors="replace")[:NAME_SIZE]
+
+
+class SharedStats(MutableMapping):
+    """Counter-like mapping backed by a memory-mapped stats file.
+
+    Can be passed to the responders in place of a `collections.Counter`.
+    The given counters get their slots up front, the rest are taken in the order
+    of their first update. Once all slots are taken, new names read as 0 and their
+    updates are summed into `_overflow`.
+    """
+
+    def __init__(self, path, slots=256, counters=()):
+        counters = list(dict.fromkeys(counters))
+        if len(counters) >= slots:
+            raise ValueError("Not enough slots for %s counters" % len(counters))
+
+        self.path = path
+        self.slots = slots
+        self._index = {}
+        self._names = {}
+        # offset -> the name the slot was created with
+        self._keys = {}
+
+        size = _slot_offset(slots)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._mm[:] = bytes(size)
+        HEADER.pack_into(
+            self._mm, 0, MAGIC, VERSION, slots, 0, os.getpid(), time.time()
+        )
+        # reserve the last slot for the names not fitting in
+        self._overflow = self._add_slot(OVERFLOW, slots - 1)
+        for name in counters:
+            self._offset(name)
+
+    def _add_slot(self, name, idx):
+        offset = _slot_offset(idx)
+        encoded = _encode_name(name)
+        SLOT.pack_into(self._mm, offset, encoded, 0)
+        self._index[name] = self._names[encoded] = offset
+        self._keys[offset] = name
+        return offset
+
+    def _lookup(self, key):
+        """Return the offset of an existing slot for the key, or None."""
+        offset = self._index.get(key)
+        if offset is None:
+            # names differing only after the truncation point share a slot
+            offset = self._names.get(_encode_name(key))
+            if offset is not None:
+                self._index[key] = offset
+        return offset
+
+    def _offset(self, key):
+        offset = self._lookup(key)
+        if offset is not None:
+            return offset
+
+        used = len(self._names) - 1
+        if used >= self.slots - 1:
+            return self._overflow
+
+        offset = self._add_slot(key, used)
+        USED.pack_into(self._mm, USED_OFFSET, used + 1)
+        return offset
+
+    def __getitem__(self, key):
+        offset = self._lookup(key)
+        if offset is None:
+            return 0
+        return VALUE.unpack_from(self._mm, offset + NAME_SIZE)[0]
+
+    def __setitem__(self, key, value):
+        offset = self._offset(key)
+        if offset == self._overflow and key != OVERFLOW:
+            # names not fitting in always read as 0, so the updates are summed up
+            value += VALUE.unpack_from(self._mm, offset + NAME_SIZE)[0]
+        VALUE.pack_into(self._mm, offset + NAME_SIZE, value)
+
+    def __delitem__(self, key):
+        raise TypeError("Counters in a stats segment cannot be removed")
+
+    def __iter__(self):
+        # like a Counter, the counters not updated yet are left out
+        return (
+            key
+            for offset, key in self._keys.items()
+            if VALUE.unpack_from(self._mm, offset + NAME_SIZE)[0]
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self))
+
+    def close(self):
+        self._mm.close()
+
+
+class StatsReader:
+    """Read-only view to a stats file written by `SharedStats`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise ValueError("%s is not a stats file" % path)
+
+        magic, version, *_ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a stats file" % path)
+
+    def snapshot(self):
+        """Return (pid, created, counters) of the current state."""
+        magic, version, slots, used, pid, created = HEADER.unpack_from(self._mm, 0)
+        counters = {}
+        for idx in list(range(used)) + [slots - 1]:
+            name, value = SLOT.unpack_from(self._mm, _slot_offset(idx))
+            name = name.rstrip(b"\0").decode("utf-8", errors="replace")
+            if name == OVERFLOW and not value:
+                continue
+            counters[name] = value
+
+        return pid, created, counters
+
+    def close(self):
+        self._mm.close()
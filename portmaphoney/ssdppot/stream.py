@@ -0,0 +1,193 @@
+"""
+Live stream of the incoming events as server-sent events.
+
+Register `EventStream.publish` as a listener to the responders and serve `make_app()`
+on a local port. Subscribers can filter the events using query parameters:
+
+    curl -N 'http://localhost:8900/events?action=AddPortMapping&port=5431&prefix=10.0.0.0/8'
+
+Each parameter can be given multiple times, an event is sent if it matches any value
+of every given parameter. The action is the SOAP action name, or `discovery` for SSDP
+and the lowercase method for other HTTP requests.
+
+Each subscriber has a bounded buffer, subscribers not keeping up are disconnected
+instead of slowing down the honeypot. Subscribers that have gone away are removed
+without counting them as dropped.
+"""
+
+import asyncio
+import ipaddress
+import json
+import logging
+from collections import Counter
+from datetime import datetime
+
+from aiohttp import web
+
+from .common import soap_action_name
+
+_LOGGER = logging.getLogger(__name__)
+
+KEEPALIVE_INTERVAL = 15
+# how often an idle handler checks whether its client is still connected
+DISCONNECT_CHECK_INTERVAL = 1
+
+SSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
+
+def event_summary(kind, data):
+    """Return the action, port and source of an event for filtering."""
+    if kind == "discovery":
+        return "discovery", 1900, data["ip"]
+
+    if "soap_action" in data:
+        action = soap_action_name(data["soap_action"])
+    else:
+        action = data["method"].lower()
+    return action, data["dstport"], data["srcip"]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def serialize_event(kind, data):
+    event = {"type": kind}
+    for key, value in data.items():
+        if key == "_id":
+            continue
+        if key == "headers":
+            value = dict(value)
+        elif isinstance(value, bytes):
+            value = value.decode("ascii", errors="replace")
+        event[key] = value
+
+    return json.dumps(event, default=_json_default)
+
+
+class Subscriber:
+    def __init__(self, actions, ports, networks, buffer_size, transport=None):
+        self.transport = transport
+        self.actions = actions
+        self.ports = ports
+        self.networks = networks
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+    def matches(self, action, port, srcip):
+        if self.actions and action not in self.actions:
+            return False
+        if self.ports and port not in self.ports:
+            return False
+        if self.networks:
+            try:
+                addr = ipaddress.ip_address(srcip)
+            except ValueError:
+                return False
+            if not any(addr in net for net in self.networks):
+                return False
+
+        return True
+
+    @property
+    def disconnected(self):
+        return self.transport is not None and self.transport.is_closing()
+
+    def close(self):
+        """Drop the buffered events and the connection of the subscriber.
+
+        The handler may be blocked writing to a client not reading anymore,
+        so the transport is aborted instead of waiting for it to drain."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+        if self.transport is not None:
+            self.transport.abort()
+
+
+class EventStream:
+    """Fan out the events to the subscribers of the stream endpoint."""
+
+    def __init__(self, buffer_size=100, stats=None):
+        self.buffer_size = buffer_size
+        if stats is None:
+            stats = Counter()
+        self.stats = stats
+        self.subscribers = set()
+
+    def publish(self, kind, data):
+        if not self.subscribers:
+            return
+
+        action, port, srcip = event_summary(kind, data)
+        payload = None
+        for sub in list(self.subscribers):
+            if sub.disconnected:
+                self.subscribers.discard(sub)
+                sub.close()
+                continue
+            if not sub.matches(action, port, srcip):
+                continue
+
+            if payload is None:
+                payload = ("data: %s\n\n" % serialize_event(kind, data)).encode()
+            try:
+                sub.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                _LOGGER.info("Dropping a stream subscriber not keeping up")
+                self.stats["stream_dropped_subscribers"] += 1
+                self.subscribers.discard(sub)
+                sub.close()
+
+    async def handle_events(self, req):
+        try:
+            actions = set(req.query.getall("action", []))
+            ports = {int(port) for port in req.query.getall("port", [])}
+            networks = [
+                ipaddress.ip_network(prefix, strict=False)
+                for prefix in req.query.getall("prefix", [])
+            ]
+        except ValueError as ex:
+            raise web.HTTPBadRequest(text="Invalid filter: %s\n" % ex)
+
+        sub = Subscriber(actions, ports, networks, self.buffer_size, req.transport)
+        resp = web.StreamResponse(headers=SSE_HEADERS)
+        await resp.prepare(req)
+
+        self.subscribers.add(sub)
+        _LOGGER.info("New stream subscriber, %s in total", len(self.subscribers))
+        loop = asyncio.get_event_loop()
+        last_write = loop.time()
+        try:
+            while True:
+                try:
+                    payload = await asyncio.wait_for(
+                        sub.queue.get(), timeout=DISCONNECT_CHECK_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    if sub.disconnected:
+                        break
+                    if loop.time() - last_write < KEEPALIVE_INTERVAL:
+                        continue
+                    payload = b": keepalive\n\n"
+
+                if payload is None:
+                    break
+                await resp.write(payload)
+                last_write = loop.time()
+        except (ConnectionError, RuntimeError) as ex:
+            _LOGGER.debug("Stream subscriber went away: %s", ex)
+        finally:
+            self.subscribers.discard(sub)
+
+        return resp
+
+    def make_app(self):
+        app = web.Application()
+        app.add_routes([web.get("/events", self.handle_events)])
+        return app
@@ -12,14 +12,23 @@ from cachetools import TTLCache
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from .common import read_data_file
+from .enrich import PrefixEnricher
 
 _LOGGER = logging.getLogger()
 
+# Counters registered up front, so that they always get a slot in the stats file
+UDP_COUNTERS = [
+    "udp_received",
+    "successfully_parsed",
+    "failed_to_parse",
+    "responses_sent",
+]
+
 
 class SSDPResponder:
     """Simple SSDP responder for all M-SEARCH queries."""
 
-    def __init__(self, collection, stats):
+    def __init__(self, collection, stats, enricher=None, listeners=None):
         payload_files = [
             "upnp-udp-payload.txt",
             "upnp-udp-payload-wanip.txt",
@@ -28,6 +37,10 @@ class SSDPResponder:
         self.responses = [read_data_file(f) for f in payload_files]
         self.stats = stats
         self.collection = collection
+        self.enricher = enricher
+        if listeners is None:
+            listeners = []
+        self.listeners = listeners
 
     def connection_made(self, transport):
         self.transport = transport
@@ -66,6 +79,8 @@ class SSDPResponder:
             "ts": datetime.utcnow(),
             "valid_request": parsed_correctly,
         }
+        if self.enricher is not None:
+            self.enricher.enrich(data, "ip")
 
         if self.addr_cache[addr] > 2:
             data["too_many_tries"] = True
@@ -75,6 +90,12 @@ class SSDPResponder:
             data["failed_to_parse"] = True
             self.stats["failed_to_parse"] += 1
 
+        for listener in self.listeners:
+            try:
+                listener("discovery", data)
+            except Exception as ex:
+                _LOGGER.error("Listener %s failed: %s", listener, ex, exc_info=True)
+
         try:
             asyncio.ensure_future(self.collection.insert_one(data))
         except Exception as ex:
@@ -116,7 +137,7 @@ async def status(stats):
         await asyncio.sleep(60)
 
 
-async def start_server(connstring, database, stats=None):
+async def start_server(connstring, database, stats=None, enricher=None, listeners=None):
     loop = asyncio.get_event_loop()
 
     if stats is None:
@@ -126,7 +147,8 @@ async def start_server(connstring, database, stats=None):
     coll = db["discoveries"]
 
     udpserver = loop.create_datagram_endpoint(
-        lambda: SSDPResponder(coll, stats), local_addr=("0.0.0.0", 1900)
+        lambda: SSDPResponder(coll, stats, enricher, listeners),
+        local_addr=("0.0.0.0", 1900),
     )
 
     _LOGGER.info("Trying to start UDP server")
@@ -137,8 +159,13 @@ async def start_server(connstring, database, stats=None):
 @click.command()
 @click.option("--connstring", default="mongodb://localhost")
 @click.option("--database", default="ssdppot")
+@click.option(
+    "--prefix-db",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Prefix to ASN/country dataset for tagging the sources",
+)
 @click.option("-d", "--debug", is_flag=True)
-def cli(connstring, database, debug):
+def cli(connstring, database, prefix_db, debug):
     loop = asyncio.get_event_loop()
 
     lvl = logging.INFO
@@ -146,7 +173,11 @@ def cli(connstring, database, debug):
         lvl = logging.DEBUG
     logging.basicConfig(level=lvl)
 
-    asyncio.ensure_future(start_server(connstring, database))
+    enricher = None
+    if prefix_db is not None:
+        enricher = PrefixEnricher(prefix_db)
+
+    asyncio.ensure_future(start_server(connstring, database, enricher=enricher))
     _LOGGER.info("started the server, running forever.")
     loop.run_forever()
 